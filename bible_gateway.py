@@ -1,7 +1,15 @@
+import gzip
 import json
 import os
 import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from time import sleep
+from urllib.error import URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 
 import meaningless.utilities.common as common
 from meaningless import JSONDownloader
@@ -13,65 +21,163 @@ def custom_get_capped_integer(number, min_value=1, max_value=200):
     return min(max(int(number), int(min_value)), int(max_value))
 
 
-# Override the original function with the custom version
+# keep-alive connections, one per download thread and host, so every chapter doesn't pay for a new tcp/tls handshake
+connections = threading.local()
+# same headers urlopen sends, so keep-alive requests look the same to Bible Gateway
+KEEP_ALIVE_HEADERS = {"Accept-Encoding": "gzip", "User-Agent": "Python-urllib/%d.%d" % sys.version_info[:2]}
+
+
+# decompress a page if the server sent it gzip compressed
+def decode_page(page, headers):
+    if headers.get("Content-Encoding") == "gzip":
+        return gzip.decompress(page)
+    return page
+
+
+# request a page over this thread's keep-alive connection, None if that didn't work out
+def get_page_keep_alive(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or getattr(connections, "disabled", False):
+        return None
+    # urlopen sends the request through a configured proxy, a direct connection would go around it
+    if parts.scheme in getproxies() and not proxy_bypass(parts.hostname):
+        return None
+    if not hasattr(connections, "open"):
+        connections.open = {}
+    key = (parts.scheme, parts.netloc)
+    conn = connections.open.get(key)
+    fresh = conn is None
+    if fresh:
+        connection_class = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+        conn = connections.open[key] = connection_class(parts.netloc, timeout=60)
+
+    target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+    try:
+        conn.request("GET", target, headers=KEEP_ALIVE_HEADERS)
+        response = conn.getresponse()
+        page = response.read()
+    except (HTTPException, OSError):
+        conn.close()
+        del connections.open[key]
+        # a reused connection most likely timed out on the server, so open a new one next time. if a new connection
+        # fails the host can't be reached directly, so stop trying instead of waiting on it for every page
+        if fresh:
+            connections.disabled = True
+        return None
+    if response.status != 200:
+        # let urlopen handle it, and keep using urlopen on this thread so a rejected request isn't sent twice per page
+        conn.close()
+        del connections.open[key]
+        connections.disabled = True
+        return None
+    return decode_page(page, response.headers)
+
+
+# Replacing the function with a version that reuses connections and asks Bible Gateway for gzip compressed pages,
+# which are several times smaller than the plain html the original function downloads
+def custom_get_page(url, retry_count=3, retry_delay=2):
+    page = get_page_keep_alive(url)
+    if page is not None:
+        return page
+    # fall back to a one-off request, which also handles redirects, errors and retries
+    retries = custom_get_capped_integer(retry_count, 0, 10)
+    delay = custom_get_capped_integer(retry_delay, 0, 30)
+    for retry in range(0, retries + 1):
+        try:
+            with urlopen(Request(url, headers={"Accept-Encoding": "gzip"})) as response:
+                return decode_page(response.read(), response.headers)
+        except URLError as exception:
+            if retry < retries:
+                sleep(delay)
+                delay *= 2
+                continue
+            raise exception
+
+
+# Override the original functions with the custom versions
 common.get_capped_integer = custom_get_capped_integer
+common.get_page = custom_get_page
 # books of the bible in order
-books = ["Genesis", "Exodus", "Leviticus", "Numbers", "Deuteronomy", "Joshua", "Judges", "Ruth", "1 Samuel",
+books = ("Genesis", "Exodus", "Leviticus", "Numbers", "Deuteronomy", "Joshua", "Judges", "Ruth", "1 Samuel",
          "2 Samuel", "1 Kings", "2 Kings", "1 Chronicles", "2 Chronicles", "Ezra", "Nehemiah", "Esther", "Job",
          "Psalm", "Proverbs", "Ecclesiastes", "Song Of Solomon", "Isaiah", "Jeremiah", "Lamentations", "Ezekiel",
          "Daniel", "Hosea", "Joel", "Amos", "Obadiah", "Jonah", "Micah", "Nahum", "Habakkuk", "Zephaniah", "Haggai",
          "Zechariah", "Malachi", "Matthew", "Mark", "Luke", "John", "Acts", "Romans", "1 Corinthians",
          "2 Corinthians", "Galatians", "Ephesians", "Philippians", "Colossians", "1 Thessalonians",
          "2 Thessalonians", "1 Timothy", "2 Timothy", "Titus", "Philemon", "Hebrews", "James", "1 Peter", "2 Peter",
-         "1 John", "2 John", "3 John", "Jude", "Revelation"]
+         "1 John", "2 John", "3 John", "Jude", "Revelation")
+# book name -> book_id, so the sql generation doesn't scan the list for every verse
+book_ids = {book: i + 1 for i, book in enumerate(books)}
+# runs of whitespace inside a verse, collapsed to a single space in the sql file
+WHITESPACE = re.compile(r'\s+')
 
 COUNT = 0
 TOTAL = 0
-
-
-# download all the books
-def download(book_name, folder, v):
-    all_clear = True
-    downloader = JSONDownloader(translation=v, show_passage_numbers=False, strip_excess_whitespace=True)
-
+# number of books downloaded at the same time, kept low to not hammer Bible Gateway
+MAX_WORKERS = 8
+
+
+# one downloader per translation, shared by all of its book downloads.
+# meaningless' own process pool is disabled so MAX_WORKERS is the only limit on concurrent requests
+def create_downloader(v):
+    return JSONDownloader(translation=v, show_passage_numbers=False, strip_excess_whitespace=True,
+                          enable_multiprocessing=False)
+
+
+# check if a book was already downloaded by a previous run and is still valid json
+def is_downloaded(book_name, folder):
+    fp = os.path.join(folder, book_name + ".json")
+    if not os.path.exists(fp):
+        return False
+    try:
+        with open(fp, 'r', encoding='utf-8') as f:
+            json.load(f)
+    except ValueError:
+        # a file cut off mid-write is either invalid json or ends inside a multibyte character
+        return False
+    return True
+
+
+# download all the books, raising if a book failed to download
+def download(book_name, folder, downloader, use_cache=False):
+    if use_cache and is_downloaded(book_name, folder):
+        return
     if not downloader.download_book(book_name, folder + "/" + book_name + ".json") == 1:
-        all_clear = False
-
-    return all_clear
+        raise RuntimeError(book_name + " failed to download.")
 
 
-# combine all the books into one json file
+# combine all the books into one json file, returning the combined data
 def combine(folder, n):
     combined_data = {}
 
-    # Iterate through all files in the folder
-    for file_name in os.listdir(folder):
-        if file_name.endswith('.json'):
-            fp = os.path.join(folder, file_name)
-
+    # Iterate through the book files in order, so the combined data needs no reordering
+    for book_name in books:
+        file_name = book_name + ".json"
+        fp = os.path.join(folder, file_name)
+        if os.path.exists(fp):
             try:
-                with open(fp, 'r') as f:
+                with open(fp, 'r', encoding='utf-8') as f:
                     data = json.load(f)
                     # Exclude the "Info" section if present
                     if "Info" in data:
                         del data["Info"]
                     # Remove extra whitespace characters from verse content
-                    for book, chapters in data.items():
-                        for chapter, verses in chapters.items():
+                    for chapters in data.values():
+                        for verses in chapters.values():
                             for verse_num, verse_content in verses.items():
                                 # Replace newline characters and excess spaces with a single space
-                                data[book][chapter][verse_num] = verse_content.strip()
+                                verses[verse_num] = verse_content.strip()
 
                     combined_data.update(data)
             except json.JSONDecodeError as e:
                 print(f"Error parsing {file_name}: {e}")
                 continue
 
-    # Write the combined data to the output file in order
-    ordered_data = {book: combined_data[book] for book in books if book in combined_data}
-
+    # Write the combined data to the output file
     with open(n, 'w') as out_file:
-        json.dump(ordered_data, out_file, indent=4)
+        json.dump(combined_data, out_file, indent=4)
+
+    return combined_data
 
 
 # a text progress bar
@@ -82,79 +188,78 @@ def generate_progress_bar(progress, total, length=20):
     return f"[{progress_bar}] {progress:2d}/{total}"
 
 
-def generate_bible(bible_translation, show_progress=True):
-    # root
-    if not os.path.exists(bible_translation):
-        os.makedirs(bible_translation)
-
+def generate_bible(bible_translation, show_progress=True, use_cache=False):
+    # root and books folder
     root = bible_translation + "/"
     path = root + bible_translation + "_books"
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    files = os.listdir(path)
-    total_files = len(files)
-    # delete all files in folder
-    for i, file in enumerate(files):
-        file_path = os.path.join(path, file)
-        os.remove(file_path)
-    if show_progress:
-        print("\rDeleted " + str(total_files) + " files.")
-    # download all files
-    flag = ""
-    for i, book in enumerate(books):
-        global COUNT, TOTAL
-        COUNT += 1
-        if not show_progress:
-            print(f"\r[+] Downloading {bible_translation[:8]:<8} ({generate_progress_bar(COUNT, TOTAL, 40)})"
-                  f" ({round((COUNT / TOTAL) * 100)}%)", end="")
-        if not download(books[i], path, bible_translation):
-            flag = book
-            break
+    os.makedirs(path, exist_ok=True)
+
+    # delete all files in folder, unless the books from a previous run are reused
+    if not use_cache:
+        files = os.listdir(path)
+        total_files = len(files)
+        for file in files:
+            file_path = os.path.join(path, file)
+            os.remove(file_path)
         if show_progress:
-            print(
-                f"\r[+] Downloading book: {book[:15]:<15} ({generate_progress_bar(i + 1, len(books), 30)})", end="")
+            print("\rDeleted " + str(total_files) + " files.")
+    # download all files
+    downloader = create_downloader(bible_translation)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(download, book, path, downloader, use_cache): book for book in books}
+        for i, future in enumerate(as_completed(futures)):
+            book = futures[future]
+            global COUNT, TOTAL
+            COUNT += 1
+            if not show_progress:
+                print(f"\r[+] Downloading {bible_translation[:8]:<8} ({generate_progress_bar(COUNT, TOTAL, 40)})"
+                      f" ({round((COUNT / TOTAL) * 100)}%)", end="")
+            try:
+                future.result()
+            except Exception:
+                # a failed book stops the script like before, without downloading the books still in the queue
+                executor.shutdown(wait=False, cancel_futures=True)
+                if show_progress:
+                    print("\r[+] ERROR: " + book + " failed to download.")
+                raise
+            if show_progress:
+                print(
+                    f"\r[+] Downloading book: {book[:15]:<15} ({generate_progress_bar(i + 1, len(books), 30)})",
+                    end="")
 
-    if flag != "":
-        if show_progress:
-            print("\r[+] ERROR: " + flag + " failed to download.")
-    else:
-        if show_progress:
-            print("\r[+] Download complete.")
+    if show_progress:
+        print("\r[+] Download complete.")
 
     # combine all books
-    combine(path, root + bible_translation + "_bible.json")
+    cd = combine(path, root + bible_translation + "_bible.json")
     if show_progress:
         print("[+] All books combined into: " + root + bible_translation + "_bible.json")
-    # generate sql
+    # generate sql from the combined data, instead of reading back the json file that was just written
     out_name = root + bible_translation + "_bible.sql"
-    in_name = root + bible_translation + "_bible.json"
     with open(out_name, 'w') as output_file:
-        with open(in_name, 'r') as input_file:
-            output_file.write(
-                "create table " + bible_translation.lower() + "(book_id int not null, book varchar(255) not null, "
-                                                              "chapter "
-                                                              "int not null, verse int not null, text varchar(1000) not "
-                                                              "null, primary key (book_id, chapter, verse));\n\n")
-
-            cd = json.load(input_file)
-
-            for book, chapters in cd.items():
-                for chapter, verses in chapters.items():
-                    output_file.write(
-                        "INSERT INTO " + bible_translation.lower() + "(book_id, book, chapter, verse, text) "
-                                                                     "VALUES\n")
-                    for verse_num, verse_content in verses.items():
-                        book_id = books.index(book) + 1
-                        verse_content = re.sub(r'\s+', ' ', verse_content)
-                        verse_content = verse_content.replace("'", "''")
-                        output_file.write("(" + str(
-                            book_id) + ",'" + book + "'," + chapter + "," + verse_num + ",'" + verse_content + "')")
-                        # Check if it's the last line
-                        if verse_num == list(verses.keys())[-1]:
-                            output_file.write(";\n")
-                        else:
-                            output_file.write(",\n")
+        output_file.write(
+            "create table " + bible_translation.lower() + "(book_id int not null, book varchar(255) not null, "
+                                                          "chapter "
+                                                          "int not null, verse int not null, text varchar(1000) not "
+                                                          "null, primary key (book_id, chapter, verse));\n\n")
+
+        # the same for every chapter, so only build it once
+        insert_into = "INSERT INTO " + bible_translation.lower() + "(book_id, book, chapter, verse, text) VALUES\n"
+        for book, chapters in cd.items():
+            book_id = book_ids[book]
+            for chapter, verses in chapters.items():
+                output_file.write(insert_into)
+                last_verse = next(reversed(verses))
+                for verse_num, verse_content in verses.items():
+                    verse_content = WHITESPACE.sub(' ', verse_content)
+                    verse_content = verse_content.replace("'", "''")
+                    output_file.write("(" + str(
+                        book_id) + ",'" + book + "'," + chapter + "," + verse_num + ",'" + verse_content + "')")
+                    # Check if it's the last line
+                    if verse_num == last_verse:
+                        output_file.write(";\n")
+                    else:
+                        output_file.write(",\n")
 
     if show_progress:
         print("[+] SQL file created: " + out_name)
@@ -167,6 +272,7 @@ if __name__ == '__main__':
         TOTAL += 66
 
     download_all = input("\n[+] Download all translations (Y/N): ").upper()
+    reuse_books = input("[+] Reuse already downloaded books (Y/N): ").upper() == "Y"
     if download_all == "Y":
         bibles_trans = list(BIBLE_TRANSLATIONS.keys())
         # remove NMB since it's not complete
@@ -175,9 +281,9 @@ if __name__ == '__main__':
         bibles_trans.sort()
         TOTAL -= 66 * 2
         for t in bibles_trans:
-            generate_bible(t, show_progress=False)
+            generate_bible(t, show_progress=False, use_cache=reuse_books)
         print("\n[+] All translations downloaded!")
 
     else:
         translation = input("[+] Translation: ").upper()
-        generate_bible(translation)
+        generate_bible(translation, use_cache=reuse_books)